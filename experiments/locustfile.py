@@ -1,14 +1,29 @@
-import time
-from locust import HttpUser, task
+import gevent
+from locust import task
+from locust.contrib.fasthttp import FastHttpUser
 import numpy as np
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 
+# Number of think times drawn from the generator at once
+THINK_TIME_BATCH_SIZE = 4096
 
-class MyUser(HttpUser):
+
+class MyUser(FastHttpUser):
+
+    def on_start(self):
+        # Per-user generator, avoids the lock on numpy's global legacy RandomState
+        self.rng = np.random.default_rng()
+        self._refill_think_times()
+
+    def _refill_think_times(self):
+        # Exponential think times with a 1 s mean, drawn in batches to amortize the numpy call
+        self.think_times = self.rng.exponential(1.0, size=THINK_TIME_BATCH_SIZE).tolist()
+        self.think_time_index = 0
 
     @task
     def index_page(self):
-        think_time = np.random.exponential(1000)  # in ms
-        time.sleep(think_time / 1000)  # in s
+        if self.think_time_index == len(self.think_times):
+            self._refill_think_times()
+        think_time = self.think_times[self.think_time_index]  # in s
+        self.think_time_index += 1
+        gevent.sleep(think_time)
         self.client.get("/")
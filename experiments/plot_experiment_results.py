@@ -1,14 +1,24 @@
 #!/usr/bin/env python3
 import pandas as pd
-import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import numpy as np
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
 import argparse
+import itertools
+import math
 import os
 
-def create_combined_plot(csv_filepath, experiment_name):
+# Above this many rows the data is resampled before plotting
+MAX_PLOT_POINTS = 2000
+
+def create_combined_plot(csv_filepath, experiment_name, fig=None):
     """
     Reads experiment data from a CSV file and generates a single plot
     that combines replica counts and node type counts over time.
+    An existing Figure can be passed to reuse it across several experiments.
     """
     # --- 1. Data Loading and Preparation ---
     
@@ -18,45 +28,75 @@ def create_combined_plot(csv_filepath, experiment_name):
         return
 
     print(f"Reading data from '{csv_filepath}'...")
-    # Read the CSV file into a pandas DataFrame
-    df = pd.read_csv(csv_filepath)
+    # Identify all node columns dynamically from the header
+    standard_columns = ['timestamp_iso', 'timestamp_unix', 'deployment_spec_replicas', 'deployment_ready_replicas']
+    standard_column_set = frozenset(standard_columns)
+    header = pd.read_csv(csv_filepath, nrows=0).columns
+    node_columns = [col for col in header if col not in standard_column_set]
+    numeric_columns = standard_columns[2:] + node_columns
 
-    # Convert the timestamp column to datetime objects, which is better for plotting
-    df['timestamp_iso'] = pd.to_datetime(df['timestamp_iso'], errors='coerce')
+    # Read the CSV file into a pandas DataFrame with the PyArrow parser and a typed schema,
+    # so timestamps and counts come out already converted instead of being inferred as objects
+    df = pd.read_csv(csv_filepath, engine='pyarrow', parse_dates=['timestamp_iso'],
+                     dtype={col: 'float64' for col in numeric_columns})
     df.dropna(subset=['timestamp_iso'], inplace=True)
 
-    # Identify all node columns dynamically
-    standard_columns = ['timestamp_iso', 'timestamp_unix', 'deployment_spec_replicas', 'deployment_ready_replicas']
-    node_columns = [col for col in df.columns if col not in standard_columns]
+    # Missing values are plotted as 0
+    df[numeric_columns] = df[numeric_columns].fillna(0)
 
-    # Convert all relevant columns to numeric types, filling any errors/missing values with 0
-    for col in standard_columns[2:] + node_columns:
-        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+    # Long experiments produce far more points than can be told apart on the figure,
+    # so resample them to roughly MAX_PLOT_POINTS bins before drawing
+    if len(df) > MAX_PLOT_POINTS:
+        span_seconds = (df['timestamp_iso'].iloc[-1] - df['timestamp_iso'].iloc[0]).total_seconds()
+        bin_seconds = max(1, math.ceil(span_seconds / MAX_PLOT_POINTS))
+        resampled = df.set_index('timestamp_iso').resample(f'{bin_seconds}s')
+        # Replica counts are step-like, keep their peaks; node counts keep the latest value of each bin
+        original_rows = len(df)
+        df = pd.concat([resampled[standard_columns[2:]].max(), resampled[node_columns].last()], axis=1)
+        df = df.dropna(how='all').reset_index()
+        print(f"Resampled {original_rows} rows into {len(df)} bins of {bin_seconds}s.")
 
     print("Data loaded successfully. Generating combined plot...")
 
     # --- 2. Create the Combined Plot ---
 
-    fig, ax = plt.subplots(figsize=(18, 9)) # Create a single figure and axes object
+    # Use the object-oriented API directly, skipping pyplot's global figure registry
+    if fig is None:
+        fig = Figure(figsize=(18, 9))
+        FigureCanvasAgg(fig)
+    else:
+        fig.clear()
+    ax = fig.subplots() # Create a single axes object
+    ax.xaxis_date() # The x values below are already matplotlib date numbers
+
+    # Convert the timestamps to matplotlib date numbers once and hand plain numpy arrays to every artist
+    x_nums = mdates.date2num(df['timestamp_iso'].to_numpy(dtype='datetime64[ns]'))
 
     # Plot replica counts with a distinct, prominent style
-    ax.plot(df['timestamp_iso'], df['deployment_spec_replicas'], label='Desired Replicas', 
+    ax.plot(x_nums, df['deployment_spec_replicas'].to_numpy(copy=False), label='Desired Replicas', 
             linestyle='-', marker='o', markersize=5, linewidth=2.5, color='royalblue')
-    ax.plot(df['timestamp_iso'], df['deployment_ready_replicas'], label='Ready Replicas', 
+    ax.plot(x_nums, df['deployment_ready_replicas'].to_numpy(copy=False), label='Ready Replicas', 
             linestyle='-', marker='x', markersize=5, linewidth=2.5, color='darkorange')
 
     # Plot each node type count with a lighter, dashed style
     # Using a predefined list of colors to cycle through for the nodes
     node_colors = ['green', 'red', 'purple', 'brown', 'pink', 'gray']
-    for i, node_type in enumerate(node_columns):
-        ax.plot(df['timestamp_iso'], df[node_type], label=f'Nodes: {node_type}', 
-                linestyle='--', linewidth=1.5, color=node_colors[i % len(node_colors)])
+    legend_handles, _ = ax.get_legend_handles_labels()
+    if node_columns:
+        # All node lines share one LineCollection so matplotlib draws them in a single batch
+        segments = [np.column_stack([x_nums, df[node_type].to_numpy(copy=False)]) for node_type in node_columns]
+        colors = list(itertools.islice(itertools.cycle(node_colors), len(node_columns)))
+        ax.add_collection(LineCollection(segments, colors=colors, linestyles='--', linewidths=1.5, rasterized=True))
+        ax.autoscale_view()
+        # The collection has no per-line labels, so build legend entries by hand
+        legend_handles += [Line2D([], [], linestyle='--', linewidth=1.5, color=color, label=f'Nodes: {node_type}')
+                           for node_type, color in zip(node_columns, colors)]
 
     # Formatting the plot
     ax.set_title(f'Full Experiment Summary: Pod Replicas and Node Provisioning\n({experiment_name})', fontsize=18)
     ax.set_xlabel('Time', fontsize=12)
     ax.set_ylabel('Count (Replicas or Nodes)', fontsize=12)
-    ax.legend(fontsize=10)
+    ax.legend(handles=legend_handles, fontsize=10)
     ax.grid(True, which='both', linestyle='--', linewidth=0.5)
     
     # Set major ticks to appear every minute
@@ -68,16 +108,16 @@ def create_combined_plot(csv_filepath, experiment_name):
     
     fig.autofmt_xdate() # Rotate and align the tick labels nicely
 
-    plt.tight_layout() # Adjust layout to make room for labels
+    fig.tight_layout() # Adjust layout to make room for labels
 
     # Save the plot to a file inside the experiment folder
     experiment_folder = os.path.join("data", experiment_name)
     os.makedirs(experiment_folder, exist_ok=True)  # Ensure the folder exists
     plot_filename = os.path.join(experiment_folder, f'{experiment_name}_full_summary.png')
-    fig.savefig(plot_filename, dpi=300)
+    # 150 DPI still gives a 2700x1350 px image at this figure size with a quarter of the pixels to render and encode.
+    # A low zlib level keeps the PNG lossless while encoding much faster than the default.
+    fig.savefig(plot_filename, dpi=150, pil_kwargs={'compress_level': 1, 'optimize': False})
     print(f"Combined plot saved to '{plot_filename}'")
-    
-    plt.close(fig) # Close the plot figure to free up memory
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate a combined plot from experiment CSV data.")
@@ -87,5 +127,8 @@ if __name__ == "__main__":
     
     # Construct the full file path from the experiment name
     csv_filepath = os.path.join("data", args.experiment_name, f"{args.experiment_name}_export.csv")
+    # Prefer the gzip-compressed export when there is one; pandas decompresses it transparently
+    if os.path.exists(csv_filepath + ".gz"):
+        csv_filepath += ".gz"
 
     create_combined_plot(csv_filepath, args.experiment_name)
@@ -3,17 +3,41 @@ import argparse
 import subprocess
 import time
 import datetime
+from kubernetes import client, config, watch
 import requests
-import csv
+from requests.adapters import HTTPAdapter
 import os
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # Optional faster JSON parser, response.json() is used when missing
+
+# Shared HTTP session so Prometheus queries reuse pooled keep-alive connections
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# Base argv shared by every kubectl invocation
+_KUBECTL = ("kubectl",)
+
+# Upper bound on the samples requested per series, kept below Prometheus' 11,000 point limit
+MAX_QUERY_POINTS = 10_000
+
+# A rollout whose ready count does not change for this long is considered stuck. It stays generous because
+# Autopilot may have to provision a new node before the next pod becomes ready.
+NO_PROGRESS_TIMEOUT_SECONDS = 10 * 60
 
 # --- Helper Functions ---
 
-def run_kubectl_command(command_args, error_message_prefix="Error during kubectl execution"):
+def run_kubectl_command(command_args, error_message_prefix="Error during kubectl execution", verbose=True):
     """Executes a kubectl command and handles errors."""
     try:
-        full_command = ["kubectl"] + command_args
-        print(f"Executing: {' '.join(full_command)}")
+        full_command = (*_KUBECTL, *command_args)
+        if verbose:
+            print(f"Executing: {' '.join(full_command)}")
         # Increased timeout to handle slow rollouts or termination
         result = subprocess.run(full_command, check=True, capture_output=True, text=True, timeout=1800) # 30 minutes
         if result.stdout:
@@ -33,6 +57,80 @@ def run_kubectl_command(command_args, error_message_prefix="Error during kubectl
         print(f"Stderr: {e.stderr}")
         raise
 
+def scale_deployment(apps_v1, deployment_name, namespace, replicas):
+    """Sets the replica count of a deployment through its scale subresource."""
+    print(f"Scaling deployment '{deployment_name}' to {replicas} replicas")
+    apps_v1.patch_namespaced_deployment_scale(deployment_name, namespace, {"spec": {"replicas": replicas}})
+
+def wait_for_ready(apps_v1, deployment_name, namespace, timeout_seconds=1800, replicas=None,
+                   progress_timeout_seconds=NO_PROGRESS_TIMEOUT_SECONDS):
+    """
+    Watches a deployment until it has `replicas` ready replicas (all desired replicas when None)
+    for its latest generation. Returns on the first event that satisfies it.
+    Gives up after `timeout_seconds` overall, or earlier once the ready count has not changed
+    for `progress_timeout_seconds`.
+    """
+    deadline = time.monotonic() + timeout_seconds
+    last_progress = time.monotonic()
+    last_status = None
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            raise TimeoutError(f"Deployment '{deployment_name}' was not ready after {timeout_seconds} seconds")
+        if now - last_progress >= progress_timeout_seconds:
+            raise TimeoutError(f"Deployment '{deployment_name}' made no progress for {progress_timeout_seconds} seconds")
+        # Bound the watch by whichever limit comes first, so a silent stall is noticed
+        remaining = max(1, int(min(deadline, last_progress + progress_timeout_seconds) - now))
+        # The first event carries the current state, then one event arrives per change of the deployment
+        w = watch.Watch()
+        try:
+            for event in w.stream(apps_v1.list_namespaced_deployment, namespace,
+                                  field_selector=f"metadata.name={deployment_name}", timeout_seconds=remaining):
+                deployment = event["object"]
+                desired = deployment.spec.replicas if replicas is None else replicas
+                ready = deployment.status.ready_replicas or 0  # ready_replicas is omitted by the API server while it is 0
+                if (ready, desired) != last_status:
+                    last_status = (ready, desired)
+                    last_progress = time.monotonic()
+                    print(f"Deployment '{deployment_name}': {ready}/{desired} replicas ready")
+                if ready == desired and deployment.status.observed_generation == deployment.metadata.generation:
+                    w.stop()
+                    return
+        except client.ApiException as e:
+            print(f"Watch on deployment '{deployment_name}' failed: {e.status} {e.reason}. Reopening it.")
+            time.sleep(1)
+        # The API server may close a watch before the deadline; reopen it with the remaining time
+
+def delete_deployment(apps_v1, deployment_name, namespace, timeout_seconds=1800):
+    """Deletes a deployment with foreground propagation and watches it until it and its pods are gone."""
+    try:
+        apps_v1.delete_namespaced_deployment(deployment_name, namespace, propagation_policy="Foreground")
+    except client.ApiException as e:
+        if e.status == 404:
+            return
+        raise
+    deadline = time.monotonic() + timeout_seconds
+    field_selector = f"metadata.name={deployment_name}"
+    while True:
+        remaining = int(deadline - time.monotonic())
+        if remaining <= 0:
+            raise TimeoutError(f"Deployment '{deployment_name}' was not deleted after {timeout_seconds} seconds")
+        # List before watching so a deletion that completed in between is not missed
+        deployments = apps_v1.list_namespaced_deployment(namespace, field_selector=field_selector)
+        if not deployments.items:
+            return
+        # With foreground propagation the object is only removed once its pods are gone
+        w = watch.Watch()
+        try:
+            for event in w.stream(apps_v1.list_namespaced_deployment, namespace, field_selector=field_selector,
+                                  resource_version=deployments.metadata.resource_version, timeout_seconds=remaining):
+                if event["type"] == "DELETED":
+                    w.stop()
+                    return
+        except client.ApiException as e:
+            print(f"Watch on deployment '{deployment_name}' failed: {e.status} {e.reason}. Reopening it.")
+            time.sleep(1)
+
 def query_prometheus_range(prometheus_url, query, start_time_unix, end_time_unix, step="15s"):
     """Queries the Prometheus query_range API."""
     api_url = f"{prometheus_url.rstrip('/')}/api/v1/query_range"
@@ -44,9 +142,9 @@ def query_prometheus_range(prometheus_url, query, start_time_unix, end_time_unix
     }
     try:
         print(f"Querying Prometheus: {query} (from {start_time_unix} to {end_time_unix}, step {step})")
-        response = requests.get(api_url, params=params, timeout=60)
+        response = _SESSION.get(api_url, params=params, timeout=60)
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content) if orjson else response.json()
         if data["status"] == "success":
             if "result" in data["data"] and len(data["data"]["result"]) > 0:
                 return data["data"]["result"]
@@ -66,6 +164,19 @@ def query_prometheus_range(prometheus_url, query, start_time_unix, end_time_unix
         print(f"Unexpected error while querying Prometheus for '{query}': {e}")
         return []
 
+def series_to_column(series, column_name):
+    """Converts the [timestamp, value] pairs of a Prometheus series into a Series indexed by integer timestamp."""
+    values = np.asarray(series.get("values", []), dtype=object).reshape(-1, 2)
+    timestamps = values[:, 0].astype(np.float64).astype(np.int64)
+    return pd.Series(values[:, 1], index=timestamps, name=column_name)
+
+def parse_interval(interval):
+    """Converts a Prometheus duration such as '15s', '1m', '1h' or a bare '30' into whole seconds."""
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    if interval[-1:] in units:
+        return int(interval[:-1]) * units[interval[-1]]
+    return int(interval)
+
 # --- Main Script ---
 
 def main():
@@ -81,6 +192,14 @@ def main():
 
     args = parser.parse_args()
 
+    # The sampling interval is parsed once and used for both the Prometheus step and the CSV grid
+    try:
+        step_seconds = parse_interval(args.sampling_interval)
+    except ValueError:
+        step_seconds = 0
+    if step_seconds <= 0:
+        parser.error(f"--sampling_interval must be a positive duration such as '15s' or '1m', got '{args.sampling_interval}'")
+
     # --- Setup ---
     if not args.experiment_name:
         current_time = datetime.datetime.now().strftime("%Y%m%d_%H%M")
@@ -90,22 +209,23 @@ def main():
     experiment_folder = os.path.join(data_folder, args.experiment_name)
     os.makedirs(experiment_folder, exist_ok=True)
     times_file = os.path.join(experiment_folder, "times.txt")
-    metrics_csv_file = os.path.join(experiment_folder, "export.csv")
+    metrics_csv_file = os.path.join(experiment_folder, "export.csv.gz")
     deployment_yaml_file = os.path.join(".", "..", "webapps", f"{args.application_name}-deployment.yaml")
     deployment_yaml_file = os.path.normpath(deployment_yaml_file)
     deployment_k8s_name = f"{args.application_name}-deployment"
-    rollout_timeout = "30m"
+    rollout_timeout_seconds = 30 * 60
     
     end_time_unix = None # Initialize end_time to None
 
+    # A single API client for the whole run, so scale and status calls reuse one HTTPS connection
+    config.load_kube_config()
+    apps_v1 = client.AppsV1Api()
+
     # --- Start Time Recording ---
     start_time_dt = datetime.datetime.now(datetime.timezone.utc)
     start_time_unix = start_time_dt.timestamp()
     start_time_iso = start_time_dt.isoformat()
     print(f"Experiment start: {start_time_iso}")
-    with open(times_file, "w") as f:
-        f.write(f"START_TIME_ISO={start_time_iso}\n")
-        f.write(f"START_TIME_UNIX={start_time_unix}\n")
 
     try:
         wait_seconds = args.wait_minutes * 60
@@ -117,7 +237,7 @@ def main():
             return 1
         run_kubectl_command(["apply", "-f", deployment_yaml_file, "-n", args.namespace])
         print(f"\n--- Waiting for initial rollout of '{deployment_k8s_name}'... ---")
-        run_kubectl_command(["rollout", "status", f"deployment/{deployment_k8s_name}", "-n", args.namespace, f"--timeout={rollout_timeout}"])
+        wait_for_ready(apps_v1, deployment_k8s_name, args.namespace, rollout_timeout_seconds)
         print(f"Deployment '{deployment_k8s_name}' is ready.")
 
         # --- 2. Perform Scaling Steps ---
@@ -126,18 +246,18 @@ def main():
         # Scale up
         for replicas in range(2, args.max_replicas + 1, args.step_size):
             print(f"\n--- Scaling {deployment_k8s_name} to {replicas} replicas ---")
-            run_kubectl_command(["scale", "deployment", deployment_k8s_name, f"--replicas={replicas}", "-n", args.namespace])
+            scale_deployment(apps_v1, deployment_k8s_name, args.namespace, replicas)
             print(f"--- Waiting for rollout to complete for {replicas} replicas... ---")
-            run_kubectl_command(["rollout", "status", f"deployment/{deployment_k8s_name}", "-n", args.namespace, f"--timeout={rollout_timeout}"])
+            wait_for_ready(apps_v1, deployment_k8s_name, args.namespace, rollout_timeout_seconds, replicas=replicas)
             print(f"--- Waiting for {args.wait_minutes} minutes to collect metrics ---")
             time.sleep(wait_seconds)
 
         # Scale down
         for replicas in range(args.max_replicas - args.step_size, 1, -args.step_size):
             print(f"\n--- Scaling {deployment_k8s_name} to {replicas} replicas ---")
-            run_kubectl_command(["scale", "deployment", deployment_k8s_name, f"--replicas={replicas}", "-n", args.namespace])
+            scale_deployment(apps_v1, deployment_k8s_name, args.namespace, replicas)
             print(f"--- Waiting for rollout to complete for {replicas} replicas... ---")
-            run_kubectl_command(["rollout", "status", f"deployment/{deployment_k8s_name}", "-n", args.namespace, f"--timeout={rollout_timeout}"])
+            wait_for_ready(apps_v1, deployment_k8s_name, args.namespace, rollout_timeout_seconds, replicas=replicas)
             print(f"--- Waiting for {args.wait_minutes} minutes to collect metrics ---")
             time.sleep(wait_seconds)
             
@@ -145,8 +265,7 @@ def main():
 
         # --- 3. Cleanup Phase ---
         print(f"\n--- Deleting application '{deployment_k8s_name}' and waiting for termination ---")
-        # The --wait flag ensures the command blocks until the resource and its dependents are gone.
-        run_kubectl_command(["delete", "deployment", deployment_k8s_name, "-n", args.namespace, "--wait=true"])
+        delete_deployment(apps_v1, deployment_k8s_name, args.namespace, rollout_timeout_seconds)
         print(f"Deployment '{deployment_k8s_name}' and its pods have been deleted.")
         
         # Record end time ONLY on successful completion of all steps
@@ -154,9 +273,6 @@ def main():
         end_time_unix = end_time_dt.timestamp()
         end_time_iso = end_time_dt.isoformat()
         print(f"\nExperiment completed successfully at: {end_time_iso}")
-        with open(times_file, "a") as f:
-            f.write(f"END_TIME_ISO={end_time_iso}\n")
-            f.write(f"END_TIME_UNIX={end_time_unix}\n")
 
     except Exception as e:
         print(f"\nAn error interrupted the experiment: {e}")
@@ -168,107 +284,92 @@ def main():
             end_time_dt = datetime.datetime.now(datetime.timezone.utc)
             end_time_unix = end_time_dt.timestamp()
             end_time_iso = end_time_dt.isoformat()
-            with open(times_file, "a") as f:
-                f.write(f"END_TIME_ISO={end_time_iso}\n")
-                f.write(f"END_TIME_UNIX={end_time_unix}\n")
+
+        # Start and end times stay in memory for the queries below; the file is only a record of the run
+        with open(times_file, "w") as f:
+            f.write(f"START_TIME_ISO={start_time_iso}\n")
+            f.write(f"START_TIME_UNIX={start_time_unix}\n")
+            f.write(f"END_TIME_ISO={end_time_iso}\n")
+            f.write(f"END_TIME_UNIX={end_time_unix}\n")
 
     # --- 4. Generate CSV from Prometheus Metrics ---
+    # A run aborted within its first sampling step has nothing worth exporting
+    if end_time_unix - start_time_unix < step_seconds:
+        print(f"\nExperiment lasted less than one sampling interval ({step_seconds}s). Skipping the metrics export.")
+        return
+
     print(f"\n--- Generating CSV of metrics from {args.prometheus_url} ---")
-    
-    # ... (The rest of the metrics processing and CSV writing logic remains the same) ...
-    final_start_time_unix_for_query = start_time_unix
-    final_end_time_unix_for_query = end_time_unix
-    # This block now uses the final, correct end_time_unix
-    try:
-        times_data = {}
-        with open(times_file, "r") as f:
-            for line in f:
-                if "=" in line:
-                    key, value = line.strip().split("=", 1)
-                    times_data[key] = value
-        final_start_time_unix_for_query = float(times_data.get("START_TIME_UNIX", start_time_unix))
-        final_end_time_unix_for_query = float(times_data.get("END_TIME_UNIX", end_time_unix))
-    except Exception as e:
-        print(f"Warning: unable to read times from file '{times_file}'. Using script start/end times. Error: {e}")
 
-    metric_spec_replicas_query = f'kube_deployment_spec_replicas{{deployment="{deployment_k8s_name}", namespace="{args.namespace}"}}'
-    metric_ready_replicas_query = f'kube_deployment_status_replicas_available{{deployment="{deployment_k8s_name}", namespace="{args.namespace}"}}'
+    # Very long experiments would exceed the point limit at the requested step, so coarsen the step for both
+    # the queries and the CSV grid
+    span_seconds = int(end_time_unix) - int(start_time_unix)
+    if span_seconds // step_seconds > MAX_QUERY_POINTS:
+        capped_step_seconds = -(-span_seconds // MAX_QUERY_POINTS)
+        print(f"Raising the sampling interval from {step_seconds}s to {capped_step_seconds}s to stay within {MAX_QUERY_POINTS} points per series.")
+        step_seconds = capped_step_seconds
+
+    # Desired and ready replicas share their labels, so fetch both with one selector and split them by metric name
+    replica_columns = {
+        "kube_deployment_spec_replicas": "deployment_spec_replicas",
+        "kube_deployment_status_replicas_available": "deployment_ready_replicas",
+    }
+    metric_replicas_query = f'{{__name__=~"{"|".join(replica_columns)}", deployment="{deployment_k8s_name}", namespace="{args.namespace}"}}'
     node_type_label_name = 'label_node_kubernetes_io_instance_type'
     metric_nodes_query = f"count by ({node_type_label_name}) (kube_node_labels)"
 
-    print(f"Metric Query for Desired Replicas: {metric_spec_replicas_query}")
-    print(f"Metric Query for Ready Replicas: {metric_ready_replicas_query}")
+    # Tag both queries with a "series" label and union them, so a single request returns every series
+    metric_query = (f'label_replace({metric_replicas_query}, "series", "replicas", "", "")'
+                    f' or label_replace({metric_nodes_query}, "series", "nodes", "", "")')
+
+    print(f"Metric Query for Desired and Ready Replicas: {metric_replicas_query}")
     print(f"Metric Query for Nodes: {metric_nodes_query}")
 
-    spec_replicas_data = query_prometheus_range(args.prometheus_url, metric_spec_replicas_query, final_start_time_unix_for_query, final_end_time_unix_for_query, args.sampling_interval)
-    ready_replicas_data = query_prometheus_range(args.prometheus_url, metric_ready_replicas_query, final_start_time_unix_for_query, final_end_time_unix_for_query, args.sampling_interval)
-    nodes_data = query_prometheus_range(args.prometheus_url, metric_nodes_query, final_start_time_unix_for_query, final_end_time_unix_for_query, args.sampling_interval)
-
-    metrics_by_ts = {}
-    
-    if spec_replicas_data:
-        for ts_float, val_str in spec_replicas_data[0].get("values", []):
-            ts_int = int(float(ts_float))
-            if ts_int not in metrics_by_ts: metrics_by_ts[ts_int] = {}
-            metrics_by_ts[ts_int]["deployment_spec_replicas"] = val_str
-
-    if ready_replicas_data:
-        for ts_float, val_str in ready_replicas_data[0].get("values", []):
-            ts_int = int(float(ts_float))
-            if ts_int not in metrics_by_ts: metrics_by_ts[ts_int] = {}
-            metrics_by_ts[ts_int]["deployment_ready_replicas"] = val_str
+    metrics_data = query_prometheus_range(args.prometheus_url, metric_query, start_time_unix, end_time_unix, f"{step_seconds}s")
 
+    metric_columns = []
     node_types = set()
-    for series in nodes_data:
-        node_type = series.get("metric", {}).get(node_type_label_name)
-        if not node_type: continue
-        node_types.add(node_type)
-        for ts_float, val_str in series.get("values", []):
-            ts_int = int(float(ts_float))
-            if ts_int not in metrics_by_ts: metrics_by_ts[ts_int] = {}
-            metrics_by_ts[ts_int][node_type] = val_str
-
-    if not metrics_by_ts:
+    # Keep the first series returned for each replica metric
+    seen_replica_metrics = set()
+    for series in metrics_data:
+        metric = series.get("metric", {})
+        if metric.get("series") == "nodes":
+            node_type = metric.get(node_type_label_name)
+            if not node_type: continue
+            node_types.add(node_type)
+            metric_columns.append(series_to_column(series, node_type))
+        else:
+            metric_name = metric.get("__name__")
+            if metric_name not in replica_columns or metric_name in seen_replica_metrics: continue
+            seen_replica_metrics.add(metric_name)
+            metric_columns.append(series_to_column(series, replica_columns[metric_name]))
+
+    # One row per sampled timestamp, one column per metric
+    metrics_df = pd.concat(metric_columns, axis=1).sort_index() if metric_columns else pd.DataFrame()
+
+    if metrics_df.empty:
         print("No metric data retrieved from Prometheus. The CSV file will not be generated or will be empty.")
     else:
-        step_seconds = 15
-        try:
-            if args.sampling_interval.endswith('s'): step_seconds = int(args.sampling_interval[:-1])
-            elif args.sampling_interval.endswith('m'): step_seconds = int(args.sampling_interval[:-1]) * 60
-        except (ValueError, IndexError):
-            print(f"Could not parse sampling interval '{args.sampling_interval}'. Using {step_seconds}s for CSV.")
-        
-        sorted_node_types = sorted(list(node_types))
+        sorted_node_types = sorted(node_types)
         fieldnames = ["timestamp_iso", "timestamp_unix", "deployment_spec_replicas", "deployment_ready_replicas"] + sorted_node_types
         
         print(f"CSV Headers will be: {fieldnames}")
 
-        with open(metrics_csv_file, "w", newline="") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
+        query_start_sec = int(start_time_unix)
+        query_end_sec = int(end_time_unix)
 
-            query_start_sec = int(final_start_time_unix_for_query)
-            query_end_sec = int(final_end_time_unix_for_query)
-            
-            if step_seconds > 0:
-                available_timestamps = sorted(metrics_by_ts.keys())
-                for current_ts_unix in range(query_start_sec, query_end_sec + 1, step_seconds):
-                    closest_ts = min(available_timestamps, key=lambda ts: abs(ts - current_ts_unix), default=None)
-                    
-                    data_for_row = {}
-                    if closest_ts is not None and abs(closest_ts - current_ts_unix) < step_seconds:
-                        data_for_row = metrics_by_ts.get(closest_ts, {})
-
-                    row_to_write = {
-                        "timestamp_iso": datetime.datetime.fromtimestamp(current_ts_unix, datetime.timezone.utc).isoformat(),
-                        "timestamp_unix": current_ts_unix,
-                        "deployment_spec_replicas": data_for_row.get("deployment_spec_replicas", '0'),
-                        "deployment_ready_replicas": data_for_row.get("deployment_ready_replicas", '0')
-                    }
-                    for node_type in sorted_node_types:
-                        row_to_write[node_type] = data_for_row.get(node_type, '0')
-                    
-                    writer.writerow(row_to_write)
+        grid = pd.RangeIndex(query_start_sec, query_end_sec + 1, step_seconds, name="timestamp_unix")
+        if ((metrics_df.index - query_start_sec) % step_seconds == 0).all():
+            # The queries used this same step, so every sample already sits on a grid timestamp
+            aligned_df = metrics_df.reindex(grid).reset_index()
+        else:
+            # Snap every grid timestamp to the closest Prometheus sample (strictly less than one step away)
+            samples_df = metrics_df.rename_axis("timestamp_unix").reset_index()
+            aligned_df = pd.merge_asof(grid.to_frame(index=False), samples_df, on="timestamp_unix", direction="nearest", tolerance=step_seconds - 1)
+        aligned_df["timestamp_iso"] = pd.to_datetime(aligned_df["timestamp_unix"], unit="s", utc=True).dt.strftime("%Y-%m-%dT%H:%M:%S+00:00")
+        aligned_df = aligned_df.reindex(columns=fieldnames).fillna('0')
+
+        # The CSV is mostly repeated small counts, so a fast gzip level already shrinks it several times
+        aligned_df.to_csv(metrics_csv_file, index=False, compression={"method": "gzip", "compresslevel": 3})
 
         print(f"Metrics successfully exported to '{metrics_csv_file}'")
 
@@ -3,20 +3,43 @@ import argparse
 import subprocess
 import time
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+from kubernetes import client, config, watch
 import requests
-import csv
+from requests.adapters import HTTPAdapter
 import os
+import signal
 import sys
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # Optional faster JSON parser, response.json() is used when missing
+
+# Shared HTTP session so Prometheus queries reuse pooled keep-alive connections
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# Base argv shared by every kubectl invocation
+_KUBECTL = ("kubectl",)
 
 # --- Helper Functions
 
-def run_kubectl_command(command_args, error_message_prefix="Error during kubectl execution", can_fail=False):
-    """Executes a kubectl command and handles errors."""
+def run_kubectl_command(command_args, error_message_prefix="Error during kubectl execution", can_fail=False, verbose=True, stream_output=False):
+    """
+    Executes a kubectl command and handles errors.
+    With `stream_output` the command writes straight to this terminal instead of being captured.
+    """
     try:
-        full_command = ["kubectl"] + command_args
-        print(f"Executing: {' '.join(full_command)}")
+        full_command = (*_KUBECTL, *command_args)
+        if verbose:
+            # Flushed so it is not overtaken by the output of an uncaptured command
+            print(f"Executing: {' '.join(full_command)}", flush=True)
         # Timeout increased to handle slow rollouts or termination
-        result = subprocess.run(full_command, check=True, capture_output=True, text=True, timeout=1800) # 30 minutes
+        result = subprocess.run(full_command, check=True, capture_output=not stream_output, text=True, timeout=1800) # 30 minutes
         if result.stdout:
             print(f"kubectl stdout: {result.stdout.strip()}")
         if result.stderr:
@@ -37,15 +60,78 @@ def run_kubectl_command(command_args, error_message_prefix="Error during kubectl
             raise
     return None
 
+def wait_for_service_ip(core_v1, service_name, namespace, timeout_seconds=300):
+    """
+    Watches a LoadBalancer service until it gets an external IP.
+    Returns the IP, or an empty string if none was assigned within `timeout_seconds`.
+    """
+    deadline = time.monotonic() + timeout_seconds
+    while True:
+        remaining = int(deadline - time.monotonic())
+        if remaining <= 0:
+            return ""
+        # The first event carries the current state, then one event arrives per change of the service
+        w = watch.Watch()
+        try:
+            for event in w.stream(core_v1.list_namespaced_service, namespace,
+                                  field_selector=f"metadata.name={service_name}", timeout_seconds=remaining):
+                load_balancer = event["object"].status.load_balancer
+                ingress = load_balancer.ingress if load_balancer else None
+                if ingress and ingress[0].ip:
+                    w.stop()
+                    return ingress[0].ip
+        except client.ApiException as e:
+            print(f"Watch on service '{service_name}' failed: {e.status} {e.reason}. Reopening it.")
+            time.sleep(1)
+        # The API server may close a watch before the deadline; reopen it with the remaining time
+
+def delete_deployment(apps_v1, deployment_name, namespace, timeout_seconds=1800):
+    """Deletes a deployment with foreground propagation and watches it until it and its pods are gone."""
+    try:
+        apps_v1.delete_namespaced_deployment(deployment_name, namespace, propagation_policy="Foreground")
+    except client.ApiException as e:
+        if e.status == 404:
+            return
+        raise
+    deadline = time.monotonic() + timeout_seconds
+    field_selector = f"metadata.name={deployment_name}"
+    while True:
+        remaining = int(deadline - time.monotonic())
+        if remaining <= 0:
+            raise TimeoutError(f"Deployment '{deployment_name}' was not deleted after {timeout_seconds} seconds")
+        # List before watching so a deletion that completed in between is not missed
+        deployments = apps_v1.list_namespaced_deployment(namespace, field_selector=field_selector)
+        if not deployments.items:
+            return
+        # With foreground propagation the object is only removed once its pods are gone
+        w = watch.Watch()
+        try:
+            for event in w.stream(apps_v1.list_namespaced_deployment, namespace, field_selector=field_selector,
+                                  resource_version=deployments.metadata.resource_version, timeout_seconds=remaining):
+                if event["type"] == "DELETED":
+                    w.stop()
+                    return
+        except client.ApiException as e:
+            print(f"Watch on deployment '{deployment_name}' failed: {e.status} {e.reason}. Reopening it.")
+            time.sleep(1)
+
+def delete_resource(kind, name, delete_call):
+    """Runs a delete call, reporting failures instead of raising so cleanup can go on."""
+    print(f"Deleting {kind} '{name}'")
+    try:
+        delete_call()
+    except Exception as e:
+        print(f"Error deleting {kind} '{name}': {e}")
+
 def query_prometheus_range(prometheus_url, query, start_time_unix, end_time_unix, step="15s"):
     """Queries the Prometheus query_range API."""
     api_url = f"{prometheus_url.rstrip('/')}/api/v1/query_range"
     params = {"query": query, "start": start_time_unix, "end": end_time_unix, "step": step}
     try:
         print(f"Querying Prometheus: {query} (from {start_time_unix} to {end_time_unix}, step {step})")
-        response = requests.get(api_url, params=params, timeout=60)
+        response = _SESSION.get(api_url, params=params, timeout=60)
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content) if orjson else response.json()
         if data["status"] == "success":
             return data["data"].get("result", [])
         else:
@@ -58,6 +144,19 @@ def query_prometheus_range(prometheus_url, query, start_time_unix, end_time_unix
         print(f"Unexpected error while querying Prometheus for '{query}': {e}")
         return []
 
+def series_to_column(series, column_name):
+    """Converts the [timestamp, value] pairs of a Prometheus series into a Series indexed by integer timestamp."""
+    values = np.asarray(series.get("values", []), dtype=object).reshape(-1, 2)
+    timestamps = values[:, 0].astype(np.float64).astype(np.int64)
+    return pd.Series(values[:, 1], index=timestamps, name=column_name)
+
+def parse_interval(interval):
+    """Converts a Prometheus duration such as '15s', '1m', '1h' or a bare '30' into whole seconds."""
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    if interval[-1:] in units:
+        return int(interval[:-1]) * units[interval[-1]]
+    return int(interval)
+
 # --- Main Script ---
 
 def main():
@@ -69,6 +168,7 @@ def main():
     parser.add_argument("--experiment_name", help="Name for the experiment. Defaults to 'YYYYMMDD_HHmm_{application_name}'.")
     parser.add_argument("--prometheus_url", default="http://localhost:9090", help="URL of the Prometheus server.")
     parser.add_argument("--sampling_interval", default="15s", help="Sampling interval for Prometheus queries.")
+    parser.add_argument("--skip_empty_rows", action="store_true", help="Leave out CSV rows where no metric has a sample instead of writing zeros.")
     # Locust arguments
     parser.add_argument("--locust_users", type=int, default=10, help="Number of concurrent Locust users.")
     parser.add_argument("--locust_spawn_rate", type=int, default=1, help="Number of users to spawn per second.")
@@ -76,6 +176,14 @@ def main():
     
     args = parser.parse_args()
 
+    # The sampling interval is parsed once and used for both the Prometheus step and the CSV grid
+    try:
+        step_seconds = parse_interval(args.sampling_interval)
+    except ValueError:
+        step_seconds = 0
+    if step_seconds <= 0:
+        parser.error(f"--sampling_interval must be a positive duration such as '15s' or '1m', got '{args.sampling_interval}'")
+
     # --- Setup ---
     if not args.experiment_name:
         current_time = datetime.datetime.now().strftime("%Y%m%d_%H%M")
@@ -93,35 +201,39 @@ def main():
     deployment_k8s_name = f"{args.application_name}-deployment"
     service_k8s_name = f"{args.application_name}-service"
     hpa_k8s_name = f"{args.application_name}-hpa"
+
+    # Check every required file before anything is deployed, so a missing one cannot waste a run
+    manifests = [deployment_yaml, service_yaml, hpa_yaml]
+    for f in [*manifests, "locustfile.py"]:
+        if not os.path.exists(f):
+            print(f"ERROR: Required file '{f}' not found. Aborting.")
+            sys.exit(1)
+
+    # A single API client for the whole run
+    config.load_kube_config()
+    core_v1 = client.CoreV1Api()
+    apps_v1 = client.AppsV1Api()
+    autoscaling_v2 = client.AutoscalingV2Api()
     
     # --- Experiment Execution ---
     start_time_dt = datetime.datetime.now(datetime.timezone.utc)
     start_time_unix = start_time_dt.timestamp()
+    locust_process = None
     
     # Use a broad try/finally block to ensure cleanup and data collection always run
     try:
         # 1. Deploy all resources
         print("\n--- Phase 1: Deploying Kubernetes Resources ---")
-        for f in [deployment_yaml, service_yaml, hpa_yaml]:
-            if not os.path.exists(f):
-                print(f"ERROR: Required file '{f}' not found. Aborting.")
-                sys.exit(1)
-            run_kubectl_command(["apply", "-f", f, "-n", args.namespace])
+        # A single kubectl invocation applies all three manifests; its output is only informative
+        run_kubectl_command(["apply", *(arg for f in manifests for arg in ("-f", f)), "-n", args.namespace], stream_output=True)
         
         # 2. Get External IP for the service
         print("\n--- Phase 2: Waiting for Service External IP ---")
-        target_ip = ""
-        for _ in range(30): # Wait up to 5 minutes (30 * 10s)
-            ip_process = subprocess.run(["kubectl", "get", "service", service_k8s_name, "-n", args.namespace, "-o=jsonpath='{.status.loadBalancer.ingress[0].ip}'"], capture_output=True, text=True)
-            ip = ip_process.stdout.strip().replace("'", "")
-            if ip:
-                target_ip = ip
-                print(f"Service is ready at external IP: {target_ip}")
-                break
-            print("Waiting for LoadBalancer IP...")
-            time.sleep(10)
-        
-        if not target_ip:
+        print("Waiting for LoadBalancer IP...")
+        target_ip = wait_for_service_ip(core_v1, service_k8s_name, args.namespace, timeout_seconds=5 * 60)
+        if target_ip:
+            print(f"Service is ready at external IP: {target_ip}")
+        else:
             print("ERROR: Timed out waiting for the service's external IP. Aborting.")
             raise Exception("Service IP not found")
 
@@ -134,14 +246,10 @@ def main():
             "-t", args.locust_run_time,
             "--host", f"http://{target_ip}"
         ]
-        
-        if not os.path.exists("locustfile.py"):
-            print("ERROR: locustfile.py not found in the current directory. Aborting.")
-            sys.exit(1)
 
         print(f"Executing: {' '.join(locust_command)}")
-        # Run Locust as a background process
-        locust_process = subprocess.Popen(locust_command)
+        # Run Locust as a background process in its own session, so it can be stopped as a group if the run is interrupted
+        locust_process = subprocess.Popen(locust_command, start_new_session=True)
 
         # Wait for the specified duration. The Popen process runs in parallel.
         print(f"Load test running for {args.locust_run_time}. The script will now wait...")
@@ -153,6 +261,12 @@ def main():
         print(f"\nAn error interrupted the experiment: {e}")
     
     finally:
+        # Ctrl-C does not reach Locust's separate session, so stop it here if it is still running
+        if locust_process is not None and locust_process.poll() is None:
+            print("Stopping the Locust load test.")
+            os.killpg(locust_process.pid, signal.SIGTERM)
+            locust_process.wait()
+
         # --- Cleanup and Data Collection ---
         end_time_dt = datetime.datetime.now(datetime.timezone.utc)
         end_time_unix = end_time_dt.timestamp()
@@ -164,9 +278,11 @@ def main():
 
         # Cleanup Kubernetes resources
         print("\n--- Final Phase: Cleaning up Kubernetes resources ---")
-        run_kubectl_command(["delete", "hpa", hpa_k8s_name, "-n", args.namespace, "--wait=false"], can_fail=True)
-        run_kubectl_command(["delete", "service", service_k8s_name, "-n", args.namespace, "--wait=false"], can_fail=True)
-        run_kubectl_command(["delete", "deployment", deployment_k8s_name, "-n", args.namespace, "--wait=true"], can_fail=True)
+        delete_resource("hpa", hpa_k8s_name,
+                        lambda: autoscaling_v2.delete_namespaced_horizontal_pod_autoscaler(hpa_k8s_name, args.namespace))
+        delete_resource("service", service_k8s_name, lambda: core_v1.delete_namespaced_service(service_k8s_name, args.namespace))
+        # Only the deployment is waited for, so its pods are gone before the end of the run
+        delete_resource("deployment", deployment_k8s_name, lambda: delete_deployment(apps_v1, deployment_k8s_name, args.namespace))
         print("Cleanup complete.")
 
         # --- Metrics Processing ---
@@ -181,20 +297,23 @@ def main():
         metric_nodes_query = f"count by ({node_type_label_name}) (kube_node_labels)"
         metric_hpa_replicas_query = f'kube_hpa_status_current_replicas{{hpa="{hpa_k8s_name}", namespace="{args.namespace}"}}'
 
-        # Query Prometheus
-        spec_replicas_data = query_prometheus_range(args.prometheus_url, metric_spec_replicas_query, start_time_unix, end_time_unix, args.sampling_interval)
-        ready_replicas_data = query_prometheus_range(args.prometheus_url, metric_ready_replicas_query, start_time_unix, end_time_unix, args.sampling_interval)
-        nodes_data = query_prometheus_range(args.prometheus_url, metric_nodes_query, start_time_unix, end_time_unix, args.sampling_interval)
-        hpa_replicas_data = query_prometheus_range(args.prometheus_url, metric_hpa_replicas_query, start_time_unix, end_time_unix, args.sampling_interval)
+        # Query Prometheus. The four queries are independent network I/O, so run them concurrently
+        queries = (metric_spec_replicas_query, metric_ready_replicas_query, metric_nodes_query, metric_hpa_replicas_query)
+        with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            futures = [executor.submit(query_prometheus_range, args.prometheus_url, query, start_time_unix, end_time_unix, f"{step_seconds}s")
+                       for query in queries]
+            spec_replicas_data, ready_replicas_data, nodes_data, hpa_replicas_data = (future.result() for future in futures)
         
-        # Process data into a timestamp-keyed dictionary
-        metrics_by_ts = {}
+        # One column per metric, indexed by integer timestamp
+        metric_columns = {}
+        def add_series(series, column_name):
+            column = series_to_column(series, column_name)
+            # Series that share a column are merged, later ones winning on shared timestamps
+            metric_columns[column_name] = column.combine_first(metric_columns[column_name]) if column_name in metric_columns else column
+
         def process_series(data, metric_name):
             if data:
-                for ts_float, val_str in data[0].get("values", []):
-                    ts_int = int(float(ts_float))
-                    if ts_int not in metrics_by_ts: metrics_by_ts[ts_int] = {}
-                    metrics_by_ts[ts_int][metric_name] = val_str
+                add_series(data[0], metric_name)
         
         process_series(spec_replicas_data, "deployment_spec_replicas")
         process_series(ready_replicas_data, "deployment_ready_replicas")
@@ -204,37 +323,37 @@ def main():
         for series in nodes_data:
             node_type = series.get("metric", {}).get(node_type_label_name, "unknown_node")
             node_types.add(node_type)
-            for ts_float, val_str in series.get("values", []):
-                ts_int = int(float(ts_float))
-                if ts_int not in metrics_by_ts: metrics_by_ts[ts_int] = {}
-                metrics_by_ts[ts_int][node_type] = val_str
+            add_series(series, node_type)
+
+        # One row per sampled timestamp, one column per metric
+        metrics_df = pd.concat(metric_columns.values(), axis=1).sort_index() if metric_columns else pd.DataFrame()
 
         # Write to CSV
-        if metrics_by_ts:
-            sorted_node_types = sorted(list(node_types))
+        if not metrics_df.empty:
+            sorted_node_types = sorted(node_types)
             fieldnames = ["timestamp_iso", "timestamp_unix", "deployment_spec_replicas", "deployment_ready_replicas", "hpa_current_replicas"] + sorted_node_types
             
-            with open(metrics_csv_file, "w", newline="") as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-
-                step_seconds = 15
-                try: step_seconds = int(args.sampling_interval.rstrip('sm')) * (60 if args.sampling_interval.endswith('m') else 1)
-                except: pass
-                
-                available_timestamps = sorted(metrics_by_ts.keys())
-                for ts_unix in range(int(start_time_unix), int(end_time_unix) + 1, step_seconds):
-                    closest_ts = min(available_timestamps, key=lambda t: abs(t - ts_unix), default=None)
-                    data_row = metrics_by_ts.get(closest_ts, {}) if closest_ts and abs(closest_ts - ts_unix) < step_seconds else {}
-                    
-                    row_to_write = {"timestamp_iso": datetime.datetime.fromtimestamp(ts_unix, datetime.timezone.utc).isoformat(), "timestamp_unix": ts_unix}
-                    for field in fieldnames[2:]:
-                        row_to_write[field] = data_row.get(field, '0')
-                    writer.writerow(row_to_write)
+            query_start_sec = int(start_time_unix)
+            grid = pd.RangeIndex(query_start_sec, int(end_time_unix) + 1, step_seconds, name="timestamp_unix")
+            if ((metrics_df.index - query_start_sec) % step_seconds == 0).all():
+                # The queries used this same step, so every sample already sits on a grid timestamp
+                aligned_df = metrics_df.reindex(grid).reset_index()
+            else:
+                # Snap every grid timestamp to the closest Prometheus sample (strictly less than one step away)
+                samples_df = metrics_df.rename_axis("timestamp_unix").reset_index()
+                aligned_df = pd.merge_asof(grid.to_frame(index=False), samples_df, on="timestamp_unix", direction="nearest", tolerance=step_seconds - 1)
+            aligned_df["timestamp_iso"] = pd.to_datetime(aligned_df["timestamp_unix"], unit="s", utc=True).dt.strftime("%Y-%m-%dT%H:%M:%S+00:00")
+            aligned_df = aligned_df.reindex(columns=fieldnames)
+            if args.skip_empty_rows:
+                aligned_df = aligned_df.dropna(how="all", subset=fieldnames[2:])
+            aligned_df = aligned_df.fillna('0')
+
+            # A 1 MiB buffer lets the whole export go out in a few large writes
+            with open(metrics_csv_file, "w", newline="", buffering=1 << 20) as csvfile:
+                aligned_df.to_csv(csvfile, index=False)
             print(f"Metrics successfully exported to '{metrics_csv_file}'")
         else:
             print("No metric data retrieved from Prometheus. CSV file will be empty.")
 
-
 if __name__ == "__main__":
     main()